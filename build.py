@@ -1,109 +1,393 @@
 #!/usr/bin/env python3
 """Build script: compile Typst notes to SVG and generate the site in dist/."""
 
+import hashlib
 import json
+import os
 import re
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
+try:
+    import typst
+except ImportError:  # fall back to the typst CLI
+    typst = None
+# Older bindings (e.g. the one in nixpkgs) lack the shared font book and the
+# Compiler API used below; use the CLI with those too.
+if typst is not None and not (hasattr(typst, "Fonts")
+                              and hasattr(typst, "Compiler")):
+    typst = None
+
 ROOT = Path(__file__).resolve().parent
 NOTES_DIR = ROOT / "notes"
 SITE_DIR = ROOT / "site"
 DIST_DIR = ROOT / "dist"
+# Kept outside dist/ so it isn't deployed with the site
+MANIFEST_FILE = ROOT / ".build-manifest.json"
+# Outdated output is moved here and deleted in the background
+TRASH_DIR = ROOT / "dist.old"
+# Plain string forms of the directories the per-note code works in, so the
+# hot path can use os.path instead of building Path objects
+NOTES_DIR_STR = str(NOTES_DIR)
+DIST_NOTES_STR = os.path.join(DIST_DIR, "notes")
+# Scratch space for intermediate compiler output, in memory where available
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Typst markup stripped by extract_preview(), in a single pass: headings,
+# function calls, math and emphasis/raw markers
+RE_STRIP = re.compile(
+    r"^=+\s+.*$|#\w+[^)\n]*\)?|\$[^$]*\$|[*_`]", re.MULTILINE
+)
+# How much of a note's source extract_preview() reads at first; a couple of
+# hundred characters of text rarely need more than this
+PREVIEW_READ_BYTES = 8192
+
+# Fixed size attributes on the root <svg> element
+RE_SVG_WIDTH = re.compile(rb'\s+width="[^"]*"')
+RE_SVG_HEIGHT = re.compile(rb'\s+height="[^"]*"')
+
+# Sets the page to wide, auto-height, minimal margins around a note
+PAGE_SETUP = "#set page(width: 700pt, height: auto, margin: (x: 30pt, y: 20pt))\n"
+
+# Serializes console output from the worker threads in build()
+print_lock = threading.Lock()
 
+# The in-process compiler is not thread-safe, so each worker thread gets its
+# own; they all share one font book so fonts are only loaded once.
+typst_fonts = typst.Fonts() if typst else None
+thread_state = threading.local()
 
-def get_git_timestamp(folder_path: str) -> int | None:
-    """Get unix timestamp of last commit touching the given path."""
+# Shared by all fast_copytree() calls; only ever runs single-file copies
+copy_pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 4) * 2))
+
+
+def load_git_timestamps() -> dict[str, int]:
+    """Map each folder below notes/ to the time of the last commit touching it.
+
+    Reads the whole history of notes/ with a single git invocation.
+    """
+    timestamps = {}
     try:
         result = subprocess.run(
-            ["git", "log", "-1", "--pretty=format:%ct", "--", folder_path],
-            capture_output=True,
+            ["git", "-c", "core.quotePath=false", "log",
+             "--pretty=format:COMMIT %ct", "--name-only", "--", "notes/"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
             text=True,
             cwd=ROOT,
         )
-        ts = result.stdout.strip()
-        if ts:
-            return int(ts)
     except Exception:
-        pass
-    return None
-
-
-def extract_preview(typ_path: Path, max_len: int = 200) -> str:
-    """Extract first max_len characters of plain text from a .typ file."""
-    text = typ_path.read_text()
-    text = re.sub(r"^=+\s+.*$", "", text, flags=re.MULTILINE)
-    text = re.sub(r"#\w+[^)\n]*\)?", "", text)
-    text = re.sub(r"\$[^$]*\$", "", text)
-    text = re.sub(r"[*_`]", "", text)
-    text = re.sub(r"\s+", " ", text).strip()
+        return timestamps
+
+    ts = None
+    for line in result.stdout.splitlines():
+        if line.startswith("COMMIT "):
+            ts = int(line[len("COMMIT "):])
+        elif line.startswith("notes/") and ts is not None:
+            # Key by every directory containing the file, so registry folders
+            # nested below notes/ ("x/y") are found too. git log is newest
+            # first, so the first commit seen is the latest.
+            parts = line.split("/")[1:-1]
+            for i in range(1, len(parts) + 1):
+                timestamps.setdefault("/".join(parts[:i]), ts)
+    return timestamps
+
+
+def hash_note(src_folder: str, title: str) -> str:
+    """Hash everything a compiled note depends on: its title and source files."""
+    h = hashlib.blake2b()
+    h.update(title.encode())
+    for dirpath, dirnames, filenames in os.walk(src_folder, followlinks=True):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, src_folder)
+        for name in sorted(filenames):
+            with open(os.path.join(dirpath, name), "rb") as f:
+                data = f.read()
+            h.update(b"\0" + os.path.join(rel_dir, name).encode())
+            h.update(b"\0%d\0" % len(data))
+            h.update(data)
+    return h.hexdigest()
+
+
+def compiler_version() -> str:
+    """Identify the typst compiler the build uses."""
+    if typst is not None:
+        return f"typst-py {getattr(typst, '__version__', 'unknown')}"
+    try:
+        result = subprocess.run(
+            ["typst", "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    except OSError:
+        return "typst unknown"
+    return result.stdout.strip()
+
+
+def get_build_hash() -> str:
+    """Hash what every note's output depends on: this script and the compiler."""
+    h = hashlib.blake2b(Path(__file__).read_bytes())
+    h.update(b"\0" + compiler_version().encode())
+    return h.hexdigest()
+
+
+def load_manifest(build_hash: str) -> dict[str, str]:
+    """Return the note hashes recorded by the previous build of dist/.
+
+    Hashes are discarded when build_hash differs, i.e. build.py or the typst
+    compiler changed, since every page could then render differently.
+    """
+    try:
+        manifest = json.loads(MANIFEST_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("build") != build_hash:
+        return {}
+    return manifest.get("notes", {})
+
+
+def strip_markup(text: str) -> str:
+    """Reduce Typst source to plain text with collapsed whitespace."""
+    return " ".join(RE_STRIP.sub("", text).split())
+
+
+def extract_preview(typ_path: str | Path, max_len: int = 200) -> str:
+    """Extract first max_len characters of plain text from a .typ file.
+
+    Only the start of the file is read unless it is too short to fill the
+    preview once markup is stripped.
+    """
+    with open(typ_path, "rb") as f:
+        head = f.read(PREVIEW_READ_BYTES)
+        text = strip_markup(head.decode("utf-8", errors="replace"))
+        if len(text) <= max_len and len(head) == PREVIEW_READ_BYTES:
+            text = strip_markup((head + f.read()).decode("utf-8", errors="replace"))
     if len(text) > max_len:
         text = text[:max_len].rsplit(" ", 1)[0] + "..."
     return text
 
 
-def build():
-    if DIST_DIR.exists():
-        shutil.rmtree(DIST_DIR)
-    DIST_DIR.mkdir()
+def copy_file(src: str | Path, dst: str | Path) -> None:
+    """Copy a file with its metadata, keeping the data in-kernel if possible.
 
-    registry = json.loads((NOTES_DIR / "notes.json").read_text())
-    notes_data = []
+    copy_file_range() lets filesystems that support it (XFS, Btrfs) share
+    extents instead of copying bytes.
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copy2(src, dst)
+        return
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            while os.copy_file_range(fin.fileno(), fout.fileno(), 1 << 30):
+                pass
+        except OSError:
+            # Not supported for this pair of files, e.g. across filesystems
+            # on older kernels
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+            shutil.copyfileobj(fin, fout)
+    shutil.copystat(src, dst)
 
-    for entry in registry:
-        title = entry["title"]
-        folder = entry["folder"]
-        labels = entry.get("labels", [])
-        src_folder = NOTES_DIR / folder
-        dst_folder = DIST_DIR / "notes" / folder
 
-        if not src_folder.exists():
-            print(f"WARNING: folder not found: {src_folder}, skipping")
-            continue
+def fast_copytree(src: str | Path, dst: str | Path, ignore=None) -> None:
+    """Like shutil.copytree(), but copies the files concurrently."""
+    futures = []
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+        if ignore is not None:
+            ignored = ignore(dirpath, dirnames + filenames)
+            dirnames[:] = [name for name in dirnames if name not in ignored]
+            filenames = [name for name in filenames if name not in ignored]
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+        for name in filenames:
+            futures.append(copy_pool.submit(
+                copy_file, os.path.join(dirpath, name), os.path.join(target, name)))
+    for future in futures:
+        future.result()
 
-        shutil.copytree(src_folder, dst_folder)
 
-        typ_file = dst_folder / "main.typ"
-        preview = extract_preview(typ_file)
+def discard(path: str | Path) -> None:
+    """Move a file or folder out of dist/ into TRASH_DIR for deletion later.
+
+    A rename is a single metadata update, so the build doesn't wait for the
+    folder to be deleted file by file.
+    """
+    os.rename(path, os.path.join(tempfile.mkdtemp(dir=TRASH_DIR), "discarded"))
+
+
+def discard_orphans(folders: set[str]) -> None:
+    """Discard everything in dist/notes/ that isn't the output of folders."""
+    # Directories above a kept note folder stay, but are searched for
+    # orphans of their own
+    parents = set()
+    for folder in folders:
+        parts = folder.split("/")
+        parents.update("/".join(parts[:i]) for i in range(1, len(parts)))
+
+    def visit(rel_dir: str) -> None:
+        for entry in os.scandir(os.path.join(DIST_NOTES_STR, rel_dir)):
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if rel in folders:
+                continue
+            if rel in parents and entry.is_dir():
+                visit(rel)
+            else:
+                discard(entry.path)
+
+    if os.path.isdir(DIST_NOTES_STR):
+        visit("")
 
-        # Create a wrapper that sets page to wide, auto-height, minimal margins
-        wrapper_file = dst_folder / "_build.typ"
-        wrapper_file.write_text(
-            '#set page(width: 700pt, height: auto, margin: (x: 30pt, y: 20pt))\n'
-            '#include "main.typ"\n'
-        )
 
-        # Compile Typst to SVG (one per page: page-{n}.svg)
-        svg_pattern = dst_folder / "page-{n}.svg"
+def compile_svg(source: str, root: str | Path) -> list[bytes]:
+    """Compile Typst source to SVG and return one UTF-8 SVG document per page.
+
+    The source is passed to the compiler directly rather than through a file;
+    absolute paths in it resolve against root.
+
+    Raises RuntimeError with the compiler diagnostics on failure.
+    """
+    if typst is not None:
+        compiler = getattr(thread_state, "compiler", None)
+        if compiler is None:
+            compiler = thread_state.compiler = typst.Compiler(font_paths=typst_fonts)
+        pages = compiler.compile(input=source.encode(), format="svg",
+                                 root=str(root))
+        if isinstance(pages, bytes):
+            pages = [pages]
+        return pages
+
+    # typst can only write multi-page SVG output as one file per page
+    # (page-{n}.svg), so let it write to scratch space and read them back.
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as tmp:
+        out_dir = Path(tmp)
         result = subprocess.run(
-            ["typst", "compile", "--format", "svg", str(wrapper_file), str(svg_pattern)],
-            capture_output=True,
+            ["typst", "compile", "--format", "svg", "--root", str(root),
+             "-", str(out_dir / "page-{n}.svg")],
+            input=source,
+            # Pages go to files; only the diagnostics are worth reading
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
             text=True,
             cwd=ROOT,
         )
         if result.returncode != 0:
-            print(f"ERROR compiling {typ_file}:")
-            print(result.stderr)
-            continue
+            raise RuntimeError(result.stderr)
+
+        # Pages are numbered from 1 without gaps; read them until one is missing
+        pages = []
+        while True:
+            try:
+                pages.append((out_dir / f"page-{len(pages) + 1}.svg").read_bytes())
+            except FileNotFoundError:
+                return pages
+
+
+def compile_note(folder: str) -> list[bytes] | None:
+    """Compile a single note to SVG pages, or print its errors and return None."""
+    src_folder = os.path.join(NOTES_DIR_STR, folder)
+    # The note's folder is the typst root, as when main.typ is compiled on
+    # its own: absolute paths in the note resolve inside it, and the note
+    # can't read files outside what hash_note() covers.
+    try:
+        return compile_svg(PAGE_SETUP + '#include "/main.typ"\n', src_folder)
+    except RuntimeError as e:
+        with print_lock:
+            print(f"ERROR compiling {os.path.join(src_folder, 'main.typ')}:")
+            # TypstError's str() is only the message; the diagnostic carries
+            # the file, line and source excerpt like the CLI's output
+            print(getattr(e, "diagnostic", e))
+        return None
+
+
+def compile_notes(folders: list[str],
+                  executor: ThreadPoolExecutor) -> dict[str, list[bytes]]:
+    """Compile notes to SVG pages, keyed by folder.
+
+    Every note is compiled as a document of its own, so outlines, counters
+    and other document-wide state only ever see that note. Notes that fail
+    to compile have their errors printed and are left out of the result.
+    """
+    pages = executor.map(compile_note, folders)
+    return {
+        folder: note_pages
+        for folder, note_pages in zip(folders, pages)
+        if note_pages is not None
+    }
+
+
+def prepare_entry(entry: dict, timestamps: dict[str, int],
+                  old_hashes: dict[str, str]) -> tuple[dict, str, bool] | None:
+    """Collect a registry entry's note data and check if it must be rebuilt.
+
+    timestamps maps note folders to their last commit time, as returned by
+    load_git_timestamps(). A note is stale unless its hash matches
+    old_hashes and its output is still in dist/; stale notes get a fresh
+    dist folder holding their assets.
+
+    Returns (note, digest, stale), or None if the note's folder is missing.
+    """
+    title = entry["title"]
+    folder = entry["folder"]
+    labels = entry.get("labels", [])
+    src_folder = os.path.join(NOTES_DIR_STR, folder)
+    dst_folder = os.path.join(DIST_NOTES_STR, folder)
+
+    if not os.path.exists(src_folder):
+        with print_lock:
+            print(f"WARNING: folder not found: {src_folder}, skipping")
+        return None
+
+    timestamp = timestamps.get(folder)
+    if timestamp is None:
+        timestamp = int(time.time())
+    note = {
+        "title": title,
+        "folder": folder,
+        "labels": labels,
+        "timestamp": timestamp,
+        "preview": extract_preview(os.path.join(src_folder, "main.typ")),
+    }
+
+    digest = hash_note(src_folder, title)
+    if (old_hashes.get(folder) == digest
+            and os.path.exists(os.path.join(dst_folder, "index.html"))):
+        return note, digest, False
+
+    if os.path.exists(dst_folder):
+        discard(dst_folder)
+    # Only the note's assets are needed in dist; sources are compiled in place
+    fast_copytree(src_folder, dst_folder, ignore=shutil.ignore_patterns("*.typ"))
+    return note, digest, True
 
-        # Collect SVG pages in order
-        svg_files = sorted(dst_folder.glob("page-*.svg"),
-                           key=lambda p: int(p.stem.split("-")[1]))
-
-        # Inline SVGs into the HTML page
-        svg_blocks = []
-        for svg_file in svg_files:
-            svg_content = svg_file.read_text()
-            # Make SVG scale to container width
-            # Remove fixed width/height attrs so CSS controls sizing
-            svg_content = re.sub(r'\s+width="[^"]*"', '', svg_content, count=1)
-            svg_content = re.sub(r'\s+height="[^"]*"', '', svg_content, count=1)
-            svg_blocks.append(svg_content)
-            svg_file.unlink()
-
-        html = f"""<!DOCTYPE html>
+
+def write_note(note: dict, pages: list[bytes] | None) -> None:
+    """Write a compiled note's index.html, or drop its dist folder if pages is None."""
+    title = note["title"]
+    dst_folder = os.path.join(DIST_NOTES_STR, note["folder"])
+    if pages is None:
+        # TRASH_DIR is already being deleted at this point
+        shutil.rmtree(dst_folder)
+        return
+
+    # Inline SVGs into the HTML page. Pages stay UTF-8 bytes throughout; only
+    # the surrounding markup is encoded.
+    svg_blocks = []
+    for svg_content in pages:
+        # Make SVG scale to container width
+        # Remove fixed width/height attrs so CSS controls sizing
+        svg_content = RE_SVG_WIDTH.sub(b'', svg_content, count=1)
+        svg_content = RE_SVG_HEIGHT.sub(b'', svg_content, count=1)
+        svg_blocks.append(svg_content)
+
+    html_head = f"""<!DOCTYPE html>
 <html lang="en">
 <head>
   <meta charset="UTF-8">
@@ -130,38 +414,70 @@ def build():
 </head>
 <body>
   <nav class="note-nav"><a href="../../">&lt; Back to notes</a></nav>
-{"".join(svg_blocks)}
-</body>
-</html>
-"""
-        (dst_folder / "index.html").write_text(html)
-
-        # Clean up .typ and build files from dist
-        for f in dst_folder.glob("*.typ"):
-            f.unlink()
-
-        timestamp = get_git_timestamp(f"notes/{folder}/")
-        if timestamp is None:
-            timestamp = int(time.time())
-
-        notes_data.append(
-            {
-                "title": title,
-                "folder": folder,
-                "labels": labels,
-                "timestamp": timestamp,
-                "preview": preview,
-            }
-        )
+""".encode()
+    with open(os.path.join(dst_folder, "index.html"), "wb") as f:
+        f.write(html_head + b"".join(svg_blocks) + b"\n</body>\n</html>\n")
+
+
+def build():
+    DIST_DIR.mkdir(exist_ok=True)
+    TRASH_DIR.mkdir(exist_ok=True)
+    build_hash = get_build_hash()
+    old_hashes = load_manifest(build_hash)
+    new_hashes = {}
+
+    # The static site files don't depend on the notes; copy them while the
+    # notes compile.
+    site_copies = [
+        copy_pool.submit(copy_file, SITE_DIR / name, DIST_DIR / name)
+        for name in ["index.html", "style.css", "script.js"]
+    ]
+
+    registry = json.loads((NOTES_DIR / "notes.json").read_text())
+    timestamps = load_git_timestamps()
+
+    # Entries write to their own dist folders, so they can be prepared,
+    # compiled and written concurrently.
+    with ThreadPoolExecutor(max_workers=min(32, os.cpu_count() or 4)) as ex:
+        worker = partial(prepare_entry, timestamps=timestamps,
+                         old_hashes=old_hashes)
+        prepared = [p for p in ex.map(worker, registry) if p is not None]
+        stale = [note for note, _, is_stale in prepared if is_stale]
+
+        # Drop output of notes that left the registry or whose sources are
+        # gone
+        discard_orphans({note["folder"] for note, _, _ in prepared})
+
+        # Everything outdated has been discarded by now; delete it while the
+        # notes compile.
+        cleanup = threading.Thread(target=shutil.rmtree, args=(TRASH_DIR,))
+        cleanup.start()
+
+        compiled = compile_notes([note["folder"] for note in stale], ex)
+        list(ex.map(lambda note: write_note(note, compiled.get(note["folder"])),
+                    stale))
+
+    notes_data = []
+    for note, digest, is_stale in prepared:
+        if is_stale and note["folder"] not in compiled:
+            continue
+        new_hashes[note["folder"]] = digest
+        notes_data.append(note)
 
     notes_data.sort(key=lambda n: n["timestamp"], reverse=True)
 
-    (DIST_DIR / "notes-data.json").write_text(
-        json.dumps(notes_data, indent=2) + "\n"
+    with open(DIST_DIR / "notes-data.json", "w") as f:
+        json.dump(notes_data, f, indent=2)
+        f.write("\n")
+
+    for future in site_copies:
+        future.result()
+
+    MANIFEST_FILE.write_text(
+        json.dumps({"build": build_hash, "notes": new_hashes}, indent=2) + "\n"
     )
 
-    for name in ["index.html", "style.css", "script.js"]:
-        shutil.copy2(SITE_DIR / name, DIST_DIR / name)
+    cleanup.join()
 
     print(f"Built {len(notes_data)} note(s) into {DIST_DIR}/")
 
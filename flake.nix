@@ -17,7 +17,7 @@
         default = pkgs.mkShell {
           packages = [
             pkgs.typst
-            pkgs.python3
+            (pkgs.python3.withPackages (ps: [ ps.typst ]))
             pkgs.git
           ];
         };